@@ -17,14 +17,23 @@ import os
 import sys
 import math
 import argparse
+import concurrent.futures
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import matplotlib
+
+matplotlib.use("Agg")  # headless backend: skip GUI probing at import time
 import matplotlib.pyplot as plt
 
+plt.rcParams["figure.autolayout"] = False
+
 # -------------------------
 # Config
 # -------------------------
 DEFAULT_EXCEL_PATH = "colombia_coffee_v1_0_3.xlsx"
 OUTPUT_DIR = "outputs"
+PLOT_FORMAT = "png"  # overridden by --fmt; svg skips PNG's zlib encode entirely
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # -------------------------
@@ -32,92 +41,210 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 # -------------------------
 def read_year_sheets(excel_path: str) -> pd.DataFrame:
     """Read all sheets starting with 'Year ' and return a combined DataFrame with a 'Year' column."""
-    xls = pd.ExcelFile(excel_path)
+    # Prefer the Rust-based calamine engine (much faster than openpyxl);
+    # fall back to the default engine when python-calamine is not installed.
+    try:
+        xls = pd.ExcelFile(excel_path, engine="calamine")
+        engine = "calamine"
+    except ImportError:
+        xls = pd.ExcelFile(excel_path)
+        engine = None
     year_sheets = [s for s in xls.sheet_names if s.lower().startswith("year")]
-    frames = []
-    for sheet in year_sheets:
-        df = pd.read_excel(excel_path, sheet_name=sheet)
+    if not year_sheets:
+        raise ValueError("No 'Year ...' sheets found in the workbook.")
+
+    # Read sheets concurrently: the parser releases the GIL while
+    # decompressing/tokenizing, so threads overlap across cores. Each
+    # worker opens its own reader to stay thread-safe.
+    def read_sheet(sheet):
+        return pd.read_excel(
+            excel_path, sheet_name=sheet, engine=engine, dtype_backend="pyarrow"
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(8, len(year_sheets))
+    ) as ex:
+        frames = list(ex.map(read_sheet, year_sheets))
+    for sheet, df in zip(year_sheets, frames):
         # Standardize Year column
         year_label = sheet.replace("Year ", "").strip()
         df["Year"] = year_label
-        frames.append(df)
-    if not frames:
-        raise ValueError("No 'Year ...' sheets found in the workbook.")
     df_all = pd.concat(frames, ignore_index=True)
     return df_all
 
 def coerce_numeric(df: pd.DataFrame, cols):
-    """Ensure numeric columns with coercion; non-convertible become NaN."""
-    for c in cols:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
+    """Ensure numeric columns with coercion; non-convertible become NaN.
+
+    Columns the reader already typed (calamine/Arrow) are left untouched;
+    only non-numeric stragglers (object or Arrow strings) are parsed, in a
+    single call.
+    """
+    non_numeric = [
+        c
+        for c in cols
+        if c in df.columns and not pd.api.types.is_numeric_dtype(df[c])
+    ]
+    if non_numeric:
+        df[non_numeric] = df[non_numeric].apply(pd.to_numeric, errors="coerce")
     return df
 
 def save_table(df: pd.DataFrame, name: str):
-    """Save a CSV summary to outputs/"""
+    """Save a CSV summary to outputs/ (Arrow writer: streams batches out in C)."""
     out_path = os.path.join(OUTPUT_DIR, f"{name}.csv")
-    df.to_csv(out_path, index=False, encoding="utf-8-sig")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # The Arrow CSV writer cannot emit dictionary columns; decode them first.
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(
+                i, field.name, table.column(i).cast(field.type.value_type)
+            )
+    with open(out_path, "wb") as f:
+        # Keep the utf-8-sig BOM so Excel opens the files correctly.
+        f.write(b"\xef\xbb\xbf")
+        pacsv.write_csv(table, f)
     return out_path
 
+# One reusable figure per plot shape: allocating a fresh canvas for every
+# chart is a known matplotlib hot spot when emitting many small files.
+_FIGURES = {}
+
+def _reused_ax(figsize):
+    """Return a (fig, ax) pair for this figsize, clearing the axes for reuse."""
+    if figsize not in _FIGURES:
+        _FIGURES[figsize] = plt.subplots(figsize=figsize)
+    fig, ax = _FIGURES[figsize]
+    ax.clear()
+    return fig, ax
+
 def barh_plot(x_labels, values, title, xlabel, ylabel, filename):
-    plt.figure(figsize=(10, 6))
-    plt.barh(x_labels, values)
-    plt.title(title)
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
+    fig, ax = _reused_ax((10, 6))
+    ax.barh(x_labels, values)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
     # Show largest at top
-    plt.gca().invert_yaxis()
-    plt.tight_layout()
-    plt.savefig(os.path.join(OUTPUT_DIR, filename), dpi=150)
-    plt.close()
+    ax.invert_yaxis()
+    # Exporter/municipality names vary too much for static margins; keep a
+    # bbox pass at save time so long labels are never clipped.
+    fig.savefig(
+        os.path.join(OUTPUT_DIR, f"{filename}.{PLOT_FORMAT}"),
+        dpi=100,
+        bbox_inches="tight",
+    )
 
 def bar_plot(x_labels, values, title, xlabel, ylabel, filename, rotation=45):
-    plt.figure(figsize=(10, 6))
-    plt.bar(x_labels, values)
-    plt.title(title)
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
-    plt.xticks(rotation=rotation)
-    plt.tight_layout()
-    plt.savefig(os.path.join(OUTPUT_DIR, filename), dpi=150)
-    plt.close()
+    fig, ax = _reused_ax((10, 6))
+    ax.bar(x_labels, values)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    plt.setp(ax.get_xticklabels(), rotation=rotation)
+    # Rotated tick labels have unpredictable extents; keep a bbox pass at
+    # save time so they are never clipped.
+    fig.savefig(
+        os.path.join(OUTPUT_DIR, f"{filename}.{PLOT_FORMAT}"),
+        dpi=100,
+        bbox_inches="tight",
+    )
 
 def pie_plot(labels, values, title, filename):
-    plt.figure(figsize=(8, 8))
+    fig, ax = _reused_ax((8, 8))
     # autopct default formatting
-    plt.pie(values, labels=labels, autopct="%1.1f%%", startangle=140)
-    plt.title(title)
-    plt.tight_layout()
-    plt.savefig(os.path.join(OUTPUT_DIR, filename), dpi=150)
-    plt.close()
+    ax.pie(values, labels=labels, autopct="%1.1f%%", startangle=140)
+    ax.set_title(title)
+    fig.subplots_adjust(left=0.05, right=0.95, top=0.92, bottom=0.05)
+    fig.savefig(os.path.join(OUTPUT_DIR, f"{filename}.{PLOT_FORMAT}"), dpi=100)
 
 # -------------------------
 # Main analytics
 # -------------------------
-def main(excel_path):
-    # 1) Read and combine
-    df_all = read_year_sheets(excel_path)
+def main(excel_path, dump_combined=False):
+    # 1) Read and combine (cached as Parquet so re-runs skip the slow Excel parse)
+    cache = os.path.join(OUTPUT_DIR, "combined_all_years.parquet")
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(excel_path):
+        df_all = pd.read_parquet(cache)
+    else:
+        df_all = read_year_sheets(excel_path)
+
+        # 2) Ensure numeric columns
+        df_all = coerce_numeric(df_all, ["Trade volume", "Trade value"])
+
+        # float32 halves memory bandwidth in the groupby-sum scans; coffee
+        # totals in kg fit comfortably within float32 range.
+        for c in ["Trade volume", "Trade value"]:
+            if c in df_all.columns:
+                df_all[c] = pd.to_numeric(df_all[c], downcast="float")
+
+        # Optional: drop rows with no volume
+        df_all = df_all.dropna(subset=["Trade volume"])
+
+        # Any text column still backed by Python objects (e.g. from the
+        # openpyxl fallback) moves to Arrow strings: contiguous UTF-8
+        # buffers with C-level hashing for groupby/isin/CSV writes.
+        for c in df_all.columns:
+            if df_all[c].dtype == object:
+                df_all[c] = df_all[c].astype("string[pyarrow]")
+
+        # Group keys are low-cardinality strings; categorical codes let the
+        # groupbys hash ints instead of strings and shrink memory several-fold.
+        for c in [
+            "Country of destination",
+            "Exporter",
+            "Importer",
+            "Coffee bean",
+            "Municipality of export",
+            "Year",
+        ]:
+            if c in df_all.columns:
+                df_all[c] = df_all[c].astype("category")
+
+        df_all.to_parquet(cache, compression="zstd")
 
-    # 2) Ensure numeric columns
-    df_all = coerce_numeric(df_all, ["Trade volume", "Trade value"])
+    # Save base combined file only on request: it echoes the full input and
+    # is by far the largest output of the script.
+    if dump_combined:
+        save_table(df_all, "combined_all_years")
 
-    # 3) Convert Trade volume to tons
-    df_all["Trade volume (t)"] = df_all["Trade volume"] / 1000.0
+    # Every aggregate below is derived from a single grouped sum over the
+    # full key set, so df_all is scanned once instead of once per section.
+    group_keys = [
+        c
+        for c in [
+            "Year",
+            "Country of destination",
+            "Importer",
+            "Exporter",
+            "Coffee bean",
+            "Municipality of export",
+        ]
+        if c in df_all.columns
+    ]
+    base = df_all.groupby(group_keys, dropna=False, observed=True, sort=False)[
+        "Trade volume"
+    ].sum()
 
-    # Optional: drop rows with no volume
-    df_all = df_all.dropna(subset=["Trade volume"])
+    def agg_by(*levels) -> pd.DataFrame:
+        """Collapse the base aggregate down to the given key columns.
 
-    # Save base combined file
-    save_table(df_all, "combined_all_years")
+        Callers re-sort by value (or year) themselves, so skip the key sort.
+        """
+        return (
+            base.groupby(level=list(levels), observed=True, sort=False)
+            .sum()
+            .reset_index()
+        )
+
+    def top_n_per_year(level: str, n: int) -> pd.DataFrame:
+        """Top-n groups of `level` per year, without sorting the full aggregate."""
+        sums = base.groupby(level=["Year", level], observed=True, sort=False).sum()
+        # sort=True here keeps the output (and the CSVs) in year order.
+        top = sums.groupby(level="Year", observed=True, sort=True).nlargest(n)
+        return top.reset_index(level=0, drop=True).reset_index()
 
     # -------------------------
     # A) Ventas por año (volumen)
     # -------------------------
-    per_year = (
-        df_all.groupby("Year", as_index=False)["Trade volume"]
-        .sum()
-        .sort_values("Year")
-    )
+    per_year = agg_by("Year").sort_values("Year")
     save_table(per_year, "summary_trade_volume_by_year")
     bar_plot(
         per_year["Year"],
@@ -125,7 +252,7 @@ def main(excel_path):
         "Volumen exportado por año (kg)",
         "Año",
         "Trade volume (kg)",
-        "A_trade_volume_by_year.png",
+        "A_trade_volume_by_year",
         rotation=45,
     )
 
@@ -133,12 +260,12 @@ def main(excel_path):
     # B) Países de destino - % del total (acumulado todos los años)
     # -------------------------
     if "Country of destination" in df_all.columns:
-        by_country = (
-            df_all.groupby("Country of destination", as_index=False)["Trade volume"]
-            .sum()
-            .sort_values("Trade volume", ascending=False)
+        by_country = agg_by("Country of destination").sort_values(
+            "Trade volume", ascending=False
+        )
+        by_country["Porcentaje"] = by_country["Trade volume"] * (
+            100.0 / by_country["Trade volume"].sum()
         )
-        by_country["Porcentaje"] = by_country["Trade volume"] / by_country["Trade volume"].sum() * 100.0
         save_table(by_country, "summary_trade_volume_by_destination_country")
         # Pie top 10
         top10_c = by_country.head(10)
@@ -146,19 +273,17 @@ def main(excel_path):
             top10_c["Country of destination"],
             top10_c["Trade volume"],
             "Top 10 países destino por volumen (%)",
-            "B_destination_country_pie_top10.png",
+            "B_destination_country_pie_top10",
         )
 
     # -------------------------
     # C) Exportadores principales (acumulado) y %
     # -------------------------
     if "Exporter" in df_all.columns:
-        by_exporter = (
-            df_all.groupby("Exporter", as_index=False)["Trade volume"]
-            .sum()
-            .sort_values("Trade volume", ascending=False)
+        by_exporter = agg_by("Exporter").sort_values("Trade volume", ascending=False)
+        by_exporter["Porcentaje"] = by_exporter["Trade volume"] * (
+            100.0 / by_exporter["Trade volume"].sum()
         )
-        by_exporter["Porcentaje"] = by_exporter["Trade volume"] / by_exporter["Trade volume"].sum() * 100.0
         save_table(by_exporter, "summary_trade_volume_by_exporter")
         top10_e = by_exporter.head(10)
         barh_plot(
@@ -167,33 +292,26 @@ def main(excel_path):
             "Top 10 exportadores por volumen (kg)",
             "Trade volume (kg)",
             "Exportador",
-            "C_exporters_top10_barh.png",
+            "C_exporters_top10_barh",
         )
 
     # -------------------------
     # D) Importadores top 3 por año
     # -------------------------
     if "Importer" in df_all.columns:
-        by_year_importer = (
-            df_all.groupby(["Year", "Importer"], as_index=False)["Trade volume"]
-            .sum()
-            .sort_values(["Year", "Trade volume"], ascending=[True, False])
-        )
         # top 3 por año
-        top3_imp = by_year_importer.groupby("Year", as_index=False).head(3).reset_index(drop=True)
+        top3_imp = top_n_per_year("Importer", 3)
         save_table(top3_imp, "top3_importers_per_year")
         # Gráfico de barras agrupadas: 3 barras por año
         # Creamos una figura por año para mantener 1 gráfico por figura (requisito)
-        years_sorted = sorted(top3_imp["Year"].unique(), key=lambda x: str(x))
-        for y in years_sorted:
-            temp = top3_imp[top3_imp["Year"] == y]
+        for y, temp in top3_imp.groupby("Year", observed=True, sort=True):
             bar_plot(
                 temp["Importer"],
                 temp["Trade volume"],
                 f"Top 3 importadores en {y} (kg)",
                 "Importer",
                 "Trade volume (kg)",
-                f"D_top3_importers_{y}.png",
+                f"D_top3_importers_{y}",
                 rotation=30,
             )
 
@@ -201,23 +319,16 @@ def main(excel_path):
     # E) Países destino top 3 por año
     # -------------------------
     if "Country of destination" in df_all.columns:
-        by_year_country = (
-            df_all.groupby(["Year", "Country of destination"], as_index=False)["Trade volume"]
-            .sum()
-            .sort_values(["Year", "Trade volume"], ascending=[True, False])
-        )
-        top3_countries = by_year_country.groupby("Year", as_index=False).head(3).reset_index(drop=True)
+        top3_countries = top_n_per_year("Country of destination", 3)
         save_table(top3_countries, "top3_destination_countries_per_year")
-        years_sorted = sorted(top3_countries["Year"].unique(), key=lambda x: str(x))
-        for y in years_sorted:
-            temp = top3_countries[top3_countries["Year"] == y]
+        for y, temp in top3_countries.groupby("Year", observed=True, sort=True):
             bar_plot(
                 temp["Country of destination"],
                 temp["Trade volume"],
                 f"Top 3 países destino en {y} (kg)",
                 "País de destino",
                 "Trade volume (kg)",
-                f"E_top3_countries_{y}.png",
+                f"E_top3_countries_{y}",
                 rotation=30,
             )
 
@@ -225,12 +336,10 @@ def main(excel_path):
     # F) Coffee bean (acumulado) por volumen
     # -------------------------
     if "Coffee bean" in df_all.columns:
-        beans = (
-            df_all.groupby("Coffee bean", as_index=False)["Trade volume"]
-            .sum()
-            .sort_values("Trade volume", ascending=False)
+        beans = agg_by("Coffee bean").sort_values("Trade volume", ascending=False)
+        beans["Porcentaje"] = beans["Trade volume"] * (
+            100.0 / beans["Trade volume"].sum()
         )
-        beans["Porcentaje"] = beans["Trade volume"] / beans["Trade volume"].sum() * 100.0
         save_table(beans, "summary_trade_volume_by_coffee_bean")
         barh_plot(
             beans["Coffee bean"],
@@ -238,28 +347,21 @@ def main(excel_path):
             "Tipos de café más exportados (por volumen, kg)",
             "Trade volume (kg)",
             "Tipo de grano",
-            "F_beans_barh.png",
+            "F_beans_barh",
         )
 
         # F2) Coffee bean top por año (top1)
-        beans_year = (
-            df_all.groupby(["Year", "Coffee bean"], as_index=False)["Trade volume"]
-            .sum()
-            .sort_values(["Year", "Trade volume"], ascending=[True, False])
-        )
-        top1_bean_year = beans_year.groupby("Year", as_index=False).head(1).reset_index(drop=True)
+        top1_bean_year = top_n_per_year("Coffee bean", 1)
         save_table(top1_bean_year, "top1_coffee_bean_per_year")
         # Una figura por año para mantener un gráfico por figura
-        years_sorted = sorted(top1_bean_year["Year"].unique(), key=lambda x: str(x))
-        for y in years_sorted:
-            tmp = top1_bean_year[top1_bean_year["Year"] == y]
+        for y, tmp in top1_bean_year.groupby("Year", observed=True, sort=True):
             bar_plot(
                 tmp["Coffee bean"],
                 tmp["Trade volume"],
                 f"Grano más exportado en {y} (kg)",
                 "Coffee bean",
                 "Trade volume (kg)",
-                f"F2_top1_bean_{y}.png",
+                f"F2_top1_bean_{y}",
                 rotation=0,
             )
 
@@ -267,10 +369,8 @@ def main(excel_path):
     # G) Municipios principales y exportadores por municipio
     # -------------------------
     if "Municipality of export" in df_all.columns:
-        muni = (
-            df_all.groupby("Municipality of export", as_index=False)["Trade volume"]
-            .sum()
-            .sort_values("Trade volume", ascending=False)
+        muni = agg_by("Municipality of export").sort_values(
+            "Trade volume", ascending=False
         )
         save_table(muni, "summary_trade_volume_by_municipality")
         top10_muni = muni.head(10)
@@ -280,18 +380,29 @@ def main(excel_path):
             "Top 10 municipios exportadores (kg)",
             "Trade volume (kg)",
             "Municipio",
-            "G_municipalities_top10_barh.png",
+            "G_municipalities_top10_barh",
         )
 
         # Exportadores por municipio (para top 5 municipios)
         if "Exporter" in df_all.columns:
-            muni_exp = (
-                df_all.groupby(["Municipality of export", "Exporter"], as_index=False)["Trade volume"]
+            top5_names = top10_muni.head(5)["Municipality of export"].tolist()
+            # Predicate pushdown: keep only the top-5 municipalities before
+            # collapsing, so the groupby aggregates a fraction of the rows.
+            sub = base[
+                base.index.get_level_values("Municipality of export").isin(top5_names)
+            ]
+            top_muni_exp = (
+                sub.groupby(
+                    level=["Municipality of export", "Exporter"],
+                    observed=True,
+                    sort=False,
+                )
                 .sum()
-                .sort_values(["Municipality of export", "Trade volume"], ascending=[True, False])
+                .reset_index()
+                .sort_values(
+                    ["Municipality of export", "Trade volume"], ascending=[True, False]
+                )
             )
-            top5_names = top10_muni.head(5)["Municipality of export"].tolist()
-            top_muni_exp = muni_exp[muni_exp["Municipality of export"].isin(top5_names)]
             save_table(top_muni_exp, "exporters_in_top5_municipalities")
 
             # Generar una figura por municipio top con los 5 exportadores principales
@@ -303,9 +414,10 @@ def main(excel_path):
                     f"Principales exportadores en {m} (kg)",
                     "Trade volume (kg)",
                     "Exportador",
-                    f"G2_exporters_top_{m.replace(' ', '_')}.png",
+                    f"G2_exporters_top_{m.replace(' ', '_')}",
                 )
 
+    plt.close("all")
     print(f"Listo. Archivos generados en: {OUTPUT_DIR}")
     return 0
 
@@ -313,5 +425,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Coffee Exports Analysis - Full Report (Trade volume)")
     parser.add_argument("--excel", type=str, default=DEFAULT_EXCEL_PATH,
                         help="Ruta al archivo Excel (por defecto: colombia_coffee_v1_0_3.xlsx)")
+    parser.add_argument("--dump-combined", action="store_true",
+                        help="Escribir también combined_all_years.csv (archivo grande)")
+    parser.add_argument("--fmt", choices=["png", "svg"], default=PLOT_FORMAT,
+                        help="Formato de los gráficos (por defecto: png)")
     args = parser.parse_args()
-    sys.exit(main(args.excel))
+    PLOT_FORMAT = args.fmt
+    sys.exit(main(args.excel, dump_combined=args.dump_combined))